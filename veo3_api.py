@@ -3,20 +3,28 @@ Veo3 API - FastAPI endpoint for generating Veo3 prompts
 """
 
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 import os
-import json
+import orjson
 import base64
 import io
+import re
+import asyncio
+import hashlib
+import logging
+import httpx
+from cachetools import TTLCache
 from PIL import Image
 from dotenv import load_dotenv
-import replicate
-import google.generativeai as genai
+from functools import lru_cache
+from contextlib import asynccontextmanager
 from typing import Optional
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Configure APIs
 REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -24,14 +32,231 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not REPLICATE_API_TOKEN or not GEMINI_API_KEY:
     raise ValueError("Missing required API keys in .env file")
 
-genai.configure(api_key=GEMINI_API_KEY)
-vision_model = genai.GenerativeModel('gemini-1.5-pro')
+# Both vision models work on ~1024px tiles, so larger uploads are downscaled
+MAX_IMAGE_EDGE = int(os.getenv("MAX_IMAGE_EDGE", "1024"))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Flux Kontext sampling; ~20 steps is enough for overlay-only edits
+FLUX_STEPS = int(os.getenv("FLUX_STEPS", "20"))
+FLUX_GUIDANCE = float(os.getenv("FLUX_GUIDANCE", "3.0"))
+
+# Uploads above this are rejected before decoding (decompression bomb guard)
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", "50000000"))
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# Leading magic bytes of the accepted upload formats
+_IMAGE_MAGIC = {
+    b"\x89PNG\r\n\x1a\n": "png",
+    b"\xff\xd8\xff": "jpeg",
+    b"RIFF": "webp",
+}
+
+
+# The Gemini and Replicate SDKs are slow to import, so they are loaded on
+# first use to keep worker startup (and /health) fast
+@lru_cache(maxsize=None)
+def _vision_model():
+    import google.generativeai as genai
+    genai.configure(api_key=GEMINI_API_KEY)
+    return genai.GenerativeModel(
+        'gemini-1.5-pro',
+        generation_config={"response_mime_type": "application/json"}
+    )
+
+
+@lru_cache(maxsize=None)
+def _replicate():
+    import replicate
+    return replicate
+
+
+def _generate_content(contents: list):
+    """Blocking Gemini call, run via asyncio.to_thread"""
+    return _vision_model().generate_content(contents)
+
+
+def _run_replicate(model: str, **kwargs):
+    """Blocking Replicate call, run via asyncio.to_thread"""
+    return _replicate().run(model, **kwargs)
+
+
+# Fenced ```json block, or else the outermost {...} span
+_JSON_RE = re.compile(r"```json\s*(\{.*?\})\s*```|(\{.*\})", re.DOTALL)
+
+# Gemini prompts; the Veo3 one is filled in with str.format(user_prompt=...)
+_ANALYSIS_PROMPT = """
+Analyze this image for video storyboarding. Provide a detailed analysis with TWO outputs:
+
+1. SCENE OVERVIEW - Analyze the image and identify:
+   - Main subjects and their potential motion paths
+   - Camera movement opportunities (pan, zoom, track, arc)
+   - Key focal points and composition elements
+   - Lighting and mood
+   - Foreground, midground, background elements
+
+2. STORYBOARD ANNOTATION INSTRUCTIONS - Create specific markup instructions:
+   - Identify 3-5 elements that should move or animate
+   - For each element, specify:
+     * What it is and where it's located
+     * How it should move (direction, speed, path)
+     * What color annotation to use (RED for hero elements, BLUE for camera, GREEN for secondary, ORANGE for timing)
+     * Specific arrow types and labels
+
+Return a JSON response like this:
+{
+  "scene_overview": {
+    "description": "Detailed 2-3 sentence scene description",
+    "main_subject": "Primary focus and its location",
+    "secondary_elements": ["element1", "element2"],
+    "mood": "Emotional tone",
+    "lighting": "Quality and direction",
+    "camera_opportunities": "Possible camera movements",
+    "motion_potential": "What could move and how"
+  },
+  "annotation_instructions": {
+    "hero_element": {
+      "what": "The main subject (e.g., boat, person, car)",
+      "location": "Where in frame (e.g., center-left)",
+      "motion": "How it moves (e.g., drifts right slowly)",
+      "annotation": "RED CIRCLE around [element]",
+      "arrow": "Curved RED ARROW showing path to the right",
+      "label": "HERO MOVES → 3 SEC"
+    },
+    "camera_motion": {
+      "type": "Camera movement type (e.g., arc, dolly, pan)",
+      "path": "Movement description",
+      "annotation": "BLUE DOTTED LINE showing path",
+      "arrows": "BLUE ARROWS at key points",
+      "label": "CAMERA ARCS 90°"
+    },
+    "secondary_elements": [
+      {
+        "what": "Secondary element",
+        "motion": "Its movement",
+        "annotation": "GREEN BOX or CIRCLE",
+        "label": "ELEMENT ACTION"
+      }
+    ],
+    "timing": {
+      "duration": "8 seconds",
+      "annotation": "ORANGE TEXT top-right",
+      "label": "SCENE 1 - 8 SEC"
+    }
+  }
+}
+"""
+
+_VEO3_PROMPT_TEMPLATE = """
+Analyze this storyboard-annotated image and the user's video description to create a comprehensive Veo3 video generation specification.
+
+The image contains colored storyboard annotations:
+- RED markings: Primary subject movement paths
+- BLUE markings: Camera movement indicators  
+- GREEN markings: Secondary elements and focal points
+- ORANGE markings: Timing and scene information
+
+User's video request: {user_prompt}
+
+Generate a detailed JSON for Veo3 video generation that incorporates BOTH the storyboard annotations AND the user's vision:
+
+{{
+  "prompt": "Main video generation prompt combining scene + user request",
+  "scene_description": "Detailed 2-3 sentence description incorporating annotated elements",
+  "camera": {{
+    "initial_position": "Starting camera position",
+    "movement": "Camera movement following BLUE annotations",
+    "focal_length": "Lens choice (e.g., 24mm wide, 50mm normal, 85mm portrait)",
+    "depth_of_field": "Shallow/deep based on scene needs",
+    "stabilization": "Smooth/handheld/dynamic"
+  }},
+  "subject_motion": {{
+    "primary": "Main subject movement following RED annotations",
+    "path": "Specific path and timing from annotations",
+    "secondary_elements": "Other moving elements from GREEN annotations"
+  }},
+  "visual_style": {{
+    "treatment": "Cinematic/documentary/artistic based on mood",
+    "color_grading": "Color treatment matching scene mood",
+    "lighting": "Natural/dramatic/soft based on image"
+  }},
+  "timing": {{
+    "duration_seconds": 8,
+    "pacing": "Rhythm based on annotation timing",
+    "key_moments": "When important actions occur"
+  }},
+  "technical_specs": {{
+    "aspect_ratio": "16:9",
+    "resolution": "4K",
+    "frame_rate": "24fps cinematic",
+    "motion_blur": "Natural motion blur"
+  }},
+  "audio_hints": {{
+    "ambience": "Environmental sounds matching scene",
+    "music_style": "Mood-appropriate score",
+    "sound_effects": ["specific sounds for actions"]
+  }},
+  "storyboard_integration": {{
+    "follow_red_paths": "Primary motion as marked",
+    "follow_blue_camera": "Camera movement as indicated",
+    "highlight_green_elements": "Ensure focal points are featured",
+    "respect_orange_timing": "Match annotated duration and pacing"
+  }},
+  "negative_prompt": "Avoid: shaky camera, abrupt cuts, unnatural motion",
+  "user_intent_integration": "{user_prompt} - incorporated throughout"
+}}
+
+IMPORTANT: Read the actual annotations in the image and incorporate those specific movements, paths, and timings into your JSON response.
+"""
+
+# Fixed lines wrapped around the per-image Flux annotation instructions
+_ANNOTATION_PROMPT_HEADER = "\n".join([
+    "Keep the original photo unchanged. Only add storyboard markup overlays.",
+    "Draw colored annotation marks as an overlay on top of the existing photo:",
+    "IMPORTANT: Do NOT recreate or modify the base image - only add annotations.",
+    ""
+])
+_ANNOTATION_PROMPT_FOOTER = "\n".join([
+    "",
+    "Use colored markers for all annotations.",
+    "Preserve the original photo completely - only add overlay markings."
+])
+
+# Shared HTTP client so Flux downloads reuse keep-alive connections
+HTTP = httpx.AsyncClient(
+    http2=True,
+    timeout=30.0,
+    limits=httpx.Limits(max_keepalive_connections=32)
+)
+
+# Pipeline results keyed by upload content hash, so repeated or retried
+# submissions of the same image skip the expensive API calls
+_ANALYSIS_CACHE = TTLCache(maxsize=256, ttl=3600)
+_ANNOTATED_CACHE = TTLCache(maxsize=256, ttl=3600)
+_VEO3_CACHE = TTLCache(maxsize=256, ttl=3600)
+# Encoded Flux input, reused when a retried request misses the annotated cache
+_DATA_URL_CACHE = TTLCache(maxsize=64, ttl=3600)
+# Futures for cache misses currently being computed, so identical concurrent
+# requests share one API call instead of each paying for it
+_inflight: dict = {}
+
+# Caps on concurrent outbound calls so bursts queue here rather than upstream
+REPLICATE_SEM = asyncio.Semaphore(int(os.getenv("REPLICATE_CONCURRENCY", "8")))
+GEMINI_SEM = asyncio.Semaphore(int(os.getenv("GEMINI_CONCURRENCY", "8")))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Close the shared HTTP client on shutdown"""
+    yield
+    await HTTP.aclose()
+
 
 # Create FastAPI app
 app = FastAPI(
     title="Veo3 Prompt Generator API",
     description="Generate Veo3 video prompts from images",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Add CORS middleware
@@ -44,251 +269,241 @@ app.add_middleware(
 )
 
 
-def image_to_base64(image: Image.Image) -> str:
+def sniff_image_format(head: bytes) -> Optional[str]:
+    """Identify PNG/JPEG/WebP from the first 12 bytes of a file"""
+    for magic, fmt in _IMAGE_MAGIC.items():
+        if head.startswith(magic):
+            # RIFF is a generic container; WebP has its tag at offset 8
+            if fmt == "webp" and head[8:12] != b"WEBP":
+                return None
+            return fmt
+    return None
+
+
+def decode_upload(fp) -> Image.Image:
+    """Validate, decode and downscale an uploaded image to RGB/L"""
+    # Check the file structure and pixel count before paying for a decode
+    fp.seek(0)
+    Image.open(fp).verify()
+    
+    # verify() leaves the image unusable, so reopen it
+    fp.seek(0)
+    pil_image = Image.open(fp)
+    if pil_image.width * pil_image.height > MAX_IMAGE_PIXELS:
+        raise Image.DecompressionBombError("Image exceeds MAX_IMAGE_PIXELS")
+    
+    # Let libjpeg decode at a reduced scale instead of full resolution
+    if pil_image.format == 'JPEG':
+        pil_image.draft('RGB', (MAX_IMAGE_EDGE, MAX_IMAGE_EDGE))
+    
+    # verify() barely checks JPEG data, so truncation only shows up here
+    pil_image.load()
+    
+    # Transparent images, including RGB/L PNGs with a tRNS colour key, are
+    # flattened onto white; other RGB and grayscale encode to JPEG as-is
+    if pil_image.mode in ('RGBA', 'LA') or 'transparency' in pil_image.info:
+        rgba = pil_image.convert('RGBA')
+        background = Image.new('RGB', rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        pil_image = background
+    elif pil_image.mode in ('RGB', 'L'):
+        pass
+    else:
+        pil_image = pil_image.convert('RGB')
+    
+    # Downscale in place, preserving aspect ratio
+    pil_image.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.Resampling.LANCZOS)
+    return pil_image
+
+
+def image_to_base64(image: Image.Image, format: str = 'JPEG') -> str:
     """Convert PIL image to base64"""
     buffer = io.BytesIO()
-    image.save(buffer, format='PNG')
-    return base64.b64encode(buffer.getvalue()).decode()
+    if format == 'JPEG':
+        image.save(buffer, format='JPEG', quality=90, optimize=False, progressive=False)
+    else:
+        image.save(buffer, format=format)
+    # Encode from a view of the buffer rather than a getvalue() copy
+    with buffer.getbuffer() as view:
+        return base64.b64encode(view).decode('ascii')
+
+
+def image_to_data_url(image: Image.Image) -> str:
+    """Convert PIL image to a data URL, JPEG unless alpha must be kept"""
+    if image.mode in ('RGBA', 'LA') or 'transparency' in image.info:
+        return f"data:image/png;base64,{image_to_base64(image, format='PNG')}"
+    return f"data:image/jpeg;base64,{image_to_base64(image)}"
 
 
-def analyze_image_for_annotations(image: Image.Image) -> dict:
+def _extract_json(text: str) -> str:
+    """Extract the JSON object from a Gemini response"""
+    text = text.strip()
+    # JSON mode returns the bare object, so the regex is only a fallback
+    if text.startswith("{"):
+        return text
+    
+    match = _JSON_RE.search(text)
+    if match is None:
+        raise ValueError("No JSON object in model response")
+    return match.group(1) or match.group(2)
+
+
+async def _cached(cache: TTLCache, key, factory):
+    """Return cache[key], coalescing concurrent misses onto one factory() call"""
+    value = cache.get(key)
+    if value is not None:
+        return value
+    
+    inflight_key = (id(cache), key)
+    task = _inflight.get(inflight_key)
+    if task is None:
+        async def fill():
+            try:
+                value = await factory()
+                cache[key] = value
+                return value
+            finally:
+                del _inflight[inflight_key]
+        
+        # The shared call runs as its own task so it outlives any one request
+        task = asyncio.ensure_future(fill())
+        # Mark the result retrieved; every waiter may have gone away
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        _inflight[inflight_key] = task
+    
+    # Shielded so a disconnecting client, owner included, can't cancel it
+    return await asyncio.shield(task)
+
+
+async def analyze_image_for_annotations(image: Image.Image) -> dict:
     """Analyze image and generate annotation instructions"""
     try:
-        prompt = """
-        Analyze this image for video storyboarding. Provide a detailed analysis with TWO outputs:
-
-        1. SCENE OVERVIEW - Analyze the image and identify:
-           - Main subjects and their potential motion paths
-           - Camera movement opportunities (pan, zoom, track, arc)
-           - Key focal points and composition elements
-           - Lighting and mood
-           - Foreground, midground, background elements
-
-        2. STORYBOARD ANNOTATION INSTRUCTIONS - Create specific markup instructions:
-           - Identify 3-5 elements that should move or animate
-           - For each element, specify:
-             * What it is and where it's located
-             * How it should move (direction, speed, path)
-             * What color annotation to use (RED for hero elements, BLUE for camera, GREEN for secondary, ORANGE for timing)
-             * Specific arrow types and labels
-
-        Return a JSON response like this:
-        {
-          "scene_overview": {
-            "description": "Detailed 2-3 sentence scene description",
-            "main_subject": "Primary focus and its location",
-            "secondary_elements": ["element1", "element2"],
-            "mood": "Emotional tone",
-            "lighting": "Quality and direction",
-            "camera_opportunities": "Possible camera movements",
-            "motion_potential": "What could move and how"
-          },
-          "annotation_instructions": {
-            "hero_element": {
-              "what": "The main subject (e.g., boat, person, car)",
-              "location": "Where in frame (e.g., center-left)",
-              "motion": "How it moves (e.g., drifts right slowly)",
-              "annotation": "RED CIRCLE around [element]",
-              "arrow": "Curved RED ARROW showing path to the right",
-              "label": "HERO MOVES → 3 SEC"
-            },
-            "camera_motion": {
-              "type": "Camera movement type (e.g., arc, dolly, pan)",
-              "path": "Movement description",
-              "annotation": "BLUE DOTTED LINE showing path",
-              "arrows": "BLUE ARROWS at key points",
-              "label": "CAMERA ARCS 90°"
-            },
-            "secondary_elements": [
-              {
-                "what": "Secondary element",
-                "motion": "Its movement",
-                "annotation": "GREEN BOX or CIRCLE",
-                "label": "ELEMENT ACTION"
-              }
-            ],
-            "timing": {
-              "duration": "8 seconds",
-              "annotation": "ORANGE TEXT top-right",
-              "label": "SCENE 1 - 8 SEC"
-            }
-          }
-        }
-        """
-        
-        response = vision_model.generate_content([image, prompt])
-        json_text = response.text
-        
-        # Extract JSON from response
-        if "```json" in json_text:
-            json_text = json_text.split("```json")[1].split("```")[0]
-        elif "{" in json_text:
-            json_text = json_text[json_text.find("{"):json_text.rfind("}")+1]
+        async with GEMINI_SEM:
+            response = await asyncio.to_thread(_generate_content, [image, _ANALYSIS_PROMPT])
+        return orjson.loads(_extract_json(response.text))
         
-        return json.loads(json_text)
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Analysis error: {str(e)}")
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Image analysis failed")
+        raise HTTPException(status_code=500, detail="Image analysis failed")
 
 
-def create_annotated_image(image: Image.Image, instructions: dict) -> Image.Image:
-    """Create AI-generated annotations using Flux"""
+def _build_annotation_prompt(ann_inst: dict) -> str:
+    """Build the natural language Flux Kontext prompt from annotation instructions"""
+    parts = [_ANNOTATION_PROMPT_HEADER]
+    
+    # Hero element
+    if 'hero_element' in ann_inst:
+        hero = ann_inst['hero_element']
+        parts += [
+            f"1. Draw a thick {hero.get('annotation', 'RED CIRCLE around main subject')}",
+            f"   Add {hero.get('arrow', 'RED ARROW showing movement')}",
+            f"   Label: '{hero.get('label', 'HERO MOVES')}'"
+        ]
+    
+    # Camera motion
+    if 'camera_motion' in ann_inst:
+        cam = ann_inst['camera_motion']
+        parts += [
+            f"2. Draw {cam.get('annotation', 'BLUE DOTTED LINE for camera path')}",
+            f"   Add {cam.get('arrows', 'BLUE ARROWS showing direction')}",
+            f"   Label: '{cam.get('label', 'CAMERA MOTION')}'"
+        ]
+    
+    # Secondary elements
+    for i, elem in enumerate(ann_inst.get('secondary_elements', ()), 3):
+        parts += [
+            f"{i}. {elem.get('annotation', 'GREEN annotation')}",
+            f"   Label: '{elem.get('label', 'ELEMENT')}'"
+        ]
+    
+    # Timing
+    if 'timing' in ann_inst:
+        timing = ann_inst['timing']
+        parts.append(f"Add {timing.get('annotation', 'ORANGE TEXT')} with '{timing.get('label', 'TIMING')}'")
+    
+    parts.append(_ANNOTATION_PROMPT_FOOTER)
+    return "\n".join(parts)
+
+
+async def create_annotated_image(
+    image: Image.Image,
+    instructions: dict,
+    img_data_url: Optional[str] = None
+) -> bytes:
+    """Create AI-generated annotations using Flux, returning the encoded image"""
     try:
         # Build natural language prompt for Flux Kontext
         ann_inst = instructions.get("annotation_instructions", {})
         
-        prompt_parts = [
-            "Keep the original photo unchanged. Only add storyboard markup overlays.",
-            "Draw colored annotation marks as an overlay on top of the existing photo:",
-            "IMPORTANT: Do NOT recreate or modify the base image - only add annotations.",
-            ""
-        ]
-        
-        # Hero element
-        if 'hero_element' in ann_inst:
-            hero = ann_inst['hero_element']
-            prompt_parts.append(f"1. Draw a thick {hero.get('annotation', 'RED CIRCLE around main subject')}")
-            prompt_parts.append(f"   Add {hero.get('arrow', 'RED ARROW showing movement')}")
-            prompt_parts.append(f"   Label: '{hero.get('label', 'HERO MOVES')}'")
-        
-        # Camera motion
-        if 'camera_motion' in ann_inst:
-            cam = ann_inst['camera_motion']
-            prompt_parts.append(f"2. Draw {cam.get('annotation', 'BLUE DOTTED LINE for camera path')}")
-            prompt_parts.append(f"   Add {cam.get('arrows', 'BLUE ARROWS showing direction')}")
-            prompt_parts.append(f"   Label: '{cam.get('label', 'CAMERA MOTION')}'")
-        
-        # Secondary elements
-        if 'secondary_elements' in ann_inst:
-            for i, elem in enumerate(ann_inst['secondary_elements'], 3):
-                prompt_parts.append(f"{i}. {elem.get('annotation', 'GREEN annotation')}")
-                prompt_parts.append(f"   Label: '{elem.get('label', 'ELEMENT')}'")
+        annotation_prompt = _build_annotation_prompt(ann_inst)
         
-        # Timing
-        if 'timing' in ann_inst:
-            timing = ann_inst['timing']
-            prompt_parts.append(f"Add {timing.get('annotation', 'ORANGE TEXT')} with '{timing.get('label', 'TIMING')}'")
+        # Convert image to base64 unless the caller already did
+        if img_data_url is None:
+            img_data_url = await asyncio.to_thread(image_to_data_url, image)
         
-        prompt_parts.extend([
-            "",
-            "Use colored markers for all annotations.",
-            "Preserve the original photo completely - only add overlay markings."
-        ])
+        # Run Flux Kontext
+        async with REPLICATE_SEM:
+            output = await asyncio.to_thread(
+                _run_replicate,
+                "black-forest-labs/flux-kontext-max",
+                input={
+                    "prompt": annotation_prompt,
+                    "input_image": img_data_url,
+                    "output_format": "png",
+                    "guidance_scale": FLUX_GUIDANCE,  # Lower guidance to preserve original more
+                    "num_inference_steps": FLUX_STEPS
+                }
+            )
         
-        annotation_prompt = "\n".join(prompt_parts)
+        if not output:
+            raise HTTPException(status_code=502, detail="Flux returned no output")
         
-        # Convert image to base64
-        img_data_url = f"data:image/png;base64,{image_to_base64(image)}"
+        if hasattr(output, 'url'):
+            image_url = output.url
+        elif isinstance(output, str):
+            image_url = output
+        else:
+            # Materialize once; Replicate iterators may be single-use
+            items = list(output) if hasattr(output, '__iter__') else [output]
+            if not items:
+                raise HTTPException(status_code=502, detail="Flux returned no output")
+            first_item = items[0]
+            image_url = first_item.url if hasattr(first_item, 'url') else str(first_item)
         
-        # Run Flux Kontext
-        output = replicate.run(
-            "black-forest-labs/flux-kontext-max",
-            input={
-                "prompt": annotation_prompt,
-                "input_image": img_data_url,
-                "guidance_scale": 3.5,  # Lower guidance to preserve original more
-                "num_inference_steps": 28  # Standard steps for quality
-            }
-        )
+        response = await HTTP.get(image_url)
+        response.raise_for_status()
+        return response.content
         
-        if output:
-            import requests
-            if hasattr(output, 'url'):
-                image_url = output.url
-            elif hasattr(output, '__iter__') and len(list(output)) > 0:
-                first_item = list(output)[0]
-                image_url = first_item.url if hasattr(first_item, 'url') else str(first_item)
-            else:
-                image_url = str(output)
-            
-            response = requests.get(image_url)
-            if response.status_code == 200:
-                return Image.open(io.BytesIO(response.content))
-            else:
-                raise Exception(f"Failed to download annotated image: {response.status_code}")
-                
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Annotation error: {str(e)}")
-
-
-def generate_veo3_json(annotated_image: Image.Image, user_prompt: str, analysis: dict) -> dict:
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Annotation failed")
+        raise HTTPException(status_code=500, detail="Annotation failed")
+
+
+async def generate_veo3_json(annotated_png: bytes, user_prompt: str, analysis: dict) -> dict:
     """Generate final Veo3 JSON from annotated image and prompt"""
     try:
-        analysis_prompt = f"""
-        Analyze this storyboard-annotated image and the user's video description to create a comprehensive Veo3 video generation specification.
-
-        The image contains colored storyboard annotations:
-        - RED markings: Primary subject movement paths
-        - BLUE markings: Camera movement indicators  
-        - GREEN markings: Secondary elements and focal points
-        - ORANGE markings: Timing and scene information
-
-        User's video request: {user_prompt}
-
-        Generate a detailed JSON for Veo3 video generation that incorporates BOTH the storyboard annotations AND the user's vision:
-
-        {{
-          "prompt": "Main video generation prompt combining scene + user request",
-          "scene_description": "Detailed 2-3 sentence description incorporating annotated elements",
-          "camera": {{
-            "initial_position": "Starting camera position",
-            "movement": "Camera movement following BLUE annotations",
-            "focal_length": "Lens choice (e.g., 24mm wide, 50mm normal, 85mm portrait)",
-            "depth_of_field": "Shallow/deep based on scene needs",
-            "stabilization": "Smooth/handheld/dynamic"
-          }},
-          "subject_motion": {{
-            "primary": "Main subject movement following RED annotations",
-            "path": "Specific path and timing from annotations",
-            "secondary_elements": "Other moving elements from GREEN annotations"
-          }},
-          "visual_style": {{
-            "treatment": "Cinematic/documentary/artistic based on mood",
-            "color_grading": "Color treatment matching scene mood",
-            "lighting": "Natural/dramatic/soft based on image"
-          }},
-          "timing": {{
-            "duration_seconds": 8,
-            "pacing": "Rhythm based on annotation timing",
-            "key_moments": "When important actions occur"
-          }},
-          "technical_specs": {{
-            "aspect_ratio": "16:9",
-            "resolution": "4K",
-            "frame_rate": "24fps cinematic",
-            "motion_blur": "Natural motion blur"
-          }},
-          "audio_hints": {{
-            "ambience": "Environmental sounds matching scene",
-            "music_style": "Mood-appropriate score",
-            "sound_effects": ["specific sounds for actions"]
-          }},
-          "storyboard_integration": {{
-            "follow_red_paths": "Primary motion as marked",
-            "follow_blue_camera": "Camera movement as indicated",
-            "highlight_green_elements": "Ensure focal points are featured",
-            "respect_orange_timing": "Match annotated duration and pacing"
-          }},
-          "negative_prompt": "Avoid: shaky camera, abrupt cuts, unnatural motion",
-          "user_intent_integration": "{user_prompt} - incorporated throughout"
-        }}
-
-        IMPORTANT: Read the actual annotations in the image and incorporate those specific movements, paths, and timings into your JSON response.
-        """
-        
-        response = vision_model.generate_content([annotated_image, analysis_prompt])
-        json_text = response.text
-        
-        # Extract JSON from response
-        if "```json" in json_text:
-            json_text = json_text.split("```json")[1].split("```")[0]
-        elif "{" in json_text:
-            json_text = json_text[json_text.find("{"):json_text.rfind("}")+1]
+        prompt = _VEO3_PROMPT_TEMPLATE.format(user_prompt=user_prompt)
+        # Send the downloaded PNG as-is rather than decoding and re-encoding it
+        annotated_image = {"mime_type": "image/png", "data": annotated_png}
+        async with GEMINI_SEM:
+            response = await asyncio.to_thread(_generate_content, [annotated_image, prompt])
+        return orjson.loads(_extract_json(response.text))
         
-        return json.loads(json_text)
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Veo3 generation error: {str(e)}")
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Veo3 generation failed")
+        raise HTTPException(status_code=500, detail="Veo3 generation failed")
+
+
+@app.get("/health")
+async def health():
+    """Liveness probe that doesn't touch either SDK"""
+    return {"ok": True}
 
 
 @app.get("/")
@@ -299,6 +514,7 @@ async def root():
         "version": "1.0.0",
         "endpoints": {
             "/generate-veo3": "POST - Generate Veo3 JSON from image and prompt",
+            "/health": "GET - Health check",
             "/docs": "GET - Interactive API documentation"
         }
     }
@@ -319,42 +535,71 @@ async def generate_veo3(
     """
     try:
         # Validate image file
-        if not image.content_type.startswith("image/"):
+        if not (image.content_type or "").startswith("image/"):
             raise HTTPException(status_code=400, detail="File must be an image")
         
-        # Read and process image
-        contents = await image.read()
-        pil_image = Image.open(io.BytesIO(contents))
+        # The content type is client-supplied, so check the magic bytes too
+        if sniff_image_format(await image.read(12)) is None:
+            raise HTTPException(status_code=400, detail="Image must be PNG, JPEG or WebP")
+        await image.seek(0)
         
-        # Convert to RGB if necessary
-        if pil_image.mode != 'RGB':
-            pil_image = pil_image.convert('RGB')
+        # Hash the upload in chunks, then let Pillow decode straight from the
+        # spooled file instead of buffering a full copy in memory
+        hasher = hashlib.blake2b(digest_size=16)
+        while chunk := await image.read(UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+        key = hasher.digest()
         
-        # Step 1: Analyze image
-        analysis = analyze_image_for_annotations(pil_image)
+        # Decoding is CPU-bound, so keep it off the event loop
+        try:
+            pil_image = await asyncio.to_thread(decode_upload, image.file)
+        except Image.DecompressionBombError:
+            raise HTTPException(status_code=413, detail="Image is too large")
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid or corrupt image file")
+        
+        # Step 1: Analyze image while the Flux input is encoded in parallel
+        analysis, img_data_url = await asyncio.gather(
+            _cached(_ANALYSIS_CACHE, key, lambda: analyze_image_for_annotations(pil_image)),
+            _cached(_DATA_URL_CACHE, key, lambda: asyncio.to_thread(image_to_data_url, pil_image))
+        )
         
         # Step 2: Create annotated image
-        annotated_image = create_annotated_image(pil_image, analysis)
+        annotated_png = await _cached(
+            _ANNOTATED_CACHE, key,
+            lambda: create_annotated_image(pil_image, analysis, img_data_url=img_data_url)
+        )
         
         # Step 3: Generate Veo3 JSON
-        veo3_json = generate_veo3_json(annotated_image, prompt, analysis)
+        prompt_key = hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+        veo3_json = await _cached(
+            _VEO3_CACHE, (key, prompt_key),
+            lambda: generate_veo3_json(annotated_png, prompt, analysis)
+        )
         
         # Return response
-        return JSONResponse(
-            content={
-                "status": "success",
-                "veo3_prompt": veo3_json,
-                "scene_analysis": analysis.get("scene_overview", {}),
-                "annotation_applied": True
-            }
-        )
+        return {
+            "status": "success",
+            "veo3_prompt": veo3_json,
+            "scene_analysis": analysis.get("scene_overview", {}),
+            "annotation_applied": True
+        }
         
     except HTTPException:
         raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Processing error: {str(e)}")
+    except Exception:
+        logger.exception("Veo3 request processing failed")
+        raise HTTPException(status_code=500, detail="Processing failed")
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Each worker is a separate process with its own HTTP client and caches
+    uvicorn.run(
+        "veo3_api:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        loop="uvloop",
+        http="httptools"
+    )
\ No newline at end of file
@@ -4,14 +4,27 @@ Veo3 Complete - All features, cleaner layout
 
 import gradio as gr
 import os
-import json
+import orjson
 import base64
 import io
+import re
+import string
+import asyncio
+import time
+import hashlib
+import threading
+from collections import OrderedDict
 from datetime import datetime
-from PIL import Image
+import numpy as np
+import requests
+import simplejpeg
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PIL import Image, ImageOps
 from dotenv import load_dotenv
 import replicate
 import google.generativeai as genai
+from google.api_core.exceptions import ResourceExhausted
 
 load_dotenv()
 
@@ -19,48 +32,484 @@ load_dotenv()
 REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
-    vision_model = genai.GenerativeModel('gemini-1.5-pro')
-else:
-    vision_model = None
+# Seconds between Replicate prediction status checks
+REPLICATE_POLL_INTERVAL = 0.5
+# Seconds before a prediction that hasn't finished is cancelled
+REPLICATE_TIMEOUT = 300
+
+# Gemini rate limits: concurrent Gemini-bound handlers, and 429 retries
+GEMINI_CONCURRENCY_LIMIT = 4
+GEMINI_MAX_RETRIES = 3
+
+# Per-process LRU caches of Gemini analyses and Flux annotations, keyed by
+# image content hash so re-processing the same image skips the API calls
+CACHE_SIZE = 64
+_ANALYSIS_CACHE = OrderedDict()
+# Veo3 specs piggy-backed on an analysis call, keyed by (image hash, video prompt)
+_VEO3_SPEC_CACHE = OrderedDict()
+_ANNOTATION_CACHE = OrderedDict()
+_cache_lock = threading.Lock()
+
+# Pooled session so Replicate CDN downloads reuse keep-alive connections
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504])
+))
+
+
+# Longest edge of the gallery thumbnails
+GALLERY_THUMB_SIZE = 256
+
+
+def _open_image(data: bytes) -> Image.Image:
+    """Decode encoded image bytes, releasing the temporary buffer right away"""
+    with io.BytesIO(data) as buffer:
+        image = Image.open(buffer)
+        image.load()
+    return image
+
+
+def _image_property(slot):
+    """Veo3State attribute that stores an image encoded and decodes it on access"""
+    return property(
+        lambda self: self._get(slot),
+        lambda self, image: self._set(slot, image)
+    )
 
 
 class Veo3State:
+    # Images are held as compressed bytes rather than decoded pixel buffers.
+    # The AI-annotated one is read by the display, gallery and Veo3 generation,
+    # so its decoded array is also kept once read, for PIL to wrap directly
+    _ARRAY_SLOTS = frozenset({"_ai"})
+    
+    __slots__ = (
+        "_orig", "_ai", "_manual", "annotation_instructions", "overview_data", "veo3_spec",
+        "_gallery_cache", "_array_cache"
+    )
+    
+    original_image = _image_property("_orig")
+    ai_annotated_image = _image_property("_ai")
+    manual_annotated_image = _image_property("_manual")
+    
     def __init__(self):
-        self.original_image = None
-        self.ai_annotated_image = None
-        self.manual_annotated_image = None
+        self._orig = None
+        self._ai = None
+        self._manual = None
         self.annotation_instructions = None
         self.overview_data = None
+        # (user_prompt, json_text) produced alongside the analysis, if any
+        self.veo3_spec = None
+        # slot -> (stored data the thumbnail was made from, (thumbnail, label))
+        self._gallery_cache = {}
+        # slot -> (stored data the array was decoded from, array)
+        self._array_cache = {}
+    
+    def _set(self, slot, image):
+        self._array_cache.pop(slot, None)
+        if image is None:
+            setattr(self, slot, None)
+            return
+        with io.BytesIO() as buffer:
+            if image.mode in ('RGBA', 'LA') or 'transparency' in image.info:
+                image.save(buffer, format='PNG', compress_level=1)
+            else:
+                if image.mode not in ('RGB', 'L'):
+                    image = image.convert('RGB')
+                image.save(buffer, format='JPEG', quality=92)
+            setattr(self, slot, buffer.getvalue())
+    
+    def _get(self, slot):
+        data = getattr(self, slot)
+        if data is None:
+            return None
+        if slot not in self._ARRAY_SLOTS:
+            return _open_image(data)
+        
+        cached = self._array_cache.get(slot)
+        if cached is None or cached[0] is not data:
+            image = _open_image(data)
+            # Only modes that round-trip through fromarray; alpha is kept
+            if image.mode not in ('RGB', 'RGBA', 'L'):
+                has_alpha = image.mode in ('LA', 'PA') or 'transparency' in image.info
+                image = image.convert('RGBA' if has_alpha else 'RGB')
+            cached = self._array_cache[slot] = (data, np.asarray(image))
+        return Image.fromarray(cached[1])
     
     def get_current_image(self):
         """Get the most recent image in the pipeline"""
-        return self.manual_annotated_image or self.ai_annotated_image or self.original_image
+        for slot in ("_manual", "_ai", "_orig"):
+            if getattr(self, slot) is not None:
+                return self._get(slot)
+        return None
+    
+    def gallery_items(self):
+        """Thumbnail/label pairs for the gallery, re-rendered only when an image changes"""
+        items = []
+        for slot, label in (("_orig", "Original"), ("_ai", "AI Annotated"), ("_manual", "Manual Annotated")):
+            data = getattr(self, slot)
+            if data is None:
+                self._gallery_cache.pop(slot, None)
+                continue
+            
+            cached = self._gallery_cache.get(slot)
+            if cached is None or cached[0] is not data:
+                thumb = self._get(slot)
+                thumb.thumbnail((GALLERY_THUMB_SIZE, GALLERY_THUMB_SIZE))
+                cached = self._gallery_cache[slot] = (data, (thumb, label))
+            items.append(cached[1])
+        return items
 
 
 # We'll use Gradio's state management instead of global state
 
+# Flux Kontext and Gemini resample internally, so anything larger is wasted upload
+MAX_UPLOAD_EDGE = 1536
+
+# Gemini system instructions; per-call turns carry only the image and user request
+_ANALYZE_PROMPT = """
+Analyze this image for video storyboarding. Provide a detailed analysis with TWO outputs:
+
+1. SCENE OVERVIEW - Analyze the image and identify:
+   - Main subjects and their potential motion paths
+   - Camera movement opportunities (pan, zoom, track, arc)
+   - Key focal points and composition elements
+   - Lighting and mood
+   - Foreground, midground, background elements
+
+2. STORYBOARD ANNOTATION INSTRUCTIONS - Create specific markup instructions:
+   - Identify 3-5 elements that should move or animate
+   - For each element, specify:
+     * What it is and where it's located
+     * How it should move (direction, speed, path)
+     * What color annotation to use (RED for hero elements, BLUE for camera, GREEN for secondary, ORANGE for timing)
+     * Specific arrow types and labels
+
+Return a JSON response like this:
+{
+  "scene_overview": {
+    "description": "Detailed 2-3 sentence scene description",
+    "main_subject": "Primary focus and its location",
+    "secondary_elements": ["element1", "element2"],
+    "mood": "Emotional tone",
+    "lighting": "Quality and direction",
+    "camera_opportunities": "Possible camera movements",
+    "motion_potential": "What could move and how"
+  },
+  "annotation_instructions": {
+    "hero_element": {
+      "what": "The main subject (e.g., boat, person, car)",
+      "location": "Where in frame (e.g., center-left)",
+      "motion": "How it moves (e.g., drifts right slowly)",
+      "annotation": "RED CIRCLE around [element]",
+      "arrow": "Curved RED ARROW showing path to the right",
+      "label": "HERO MOVES → 3 SEC"
+    },
+    "camera_motion": {
+      "type": "Camera movement type (e.g., arc, dolly, pan)",
+      "path": "Movement description",
+      "annotation": "BLUE DOTTED LINE showing path",
+      "arrows": "BLUE ARROWS at key points",
+      "label": "CAMERA ARCS 90°"
+    },
+    "secondary_elements": [
+      {
+        "what": "Secondary element",
+        "motion": "Its movement",
+        "annotation": "GREEN BOX or CIRCLE",
+        "label": "ELEMENT ACTION"
+      }
+    ],
+    "timing": {
+      "duration": "8 seconds",
+      "annotation": "ORANGE TEXT top-right",
+      "label": "SCENE 1 - 8 SEC"
+    }
+  }
+}
+"""
+
+# JSON shape of a Veo3 spec, shared by the standalone and combined prompts
+_VEO3_JSON_SHAPE = """
+{
+  "prompt": "Main video generation prompt combining scene + user request",
+  "scene_description": "Detailed 2-3 sentence description incorporating annotated elements",
+  "camera": {
+    "initial_position": "Starting camera position",
+    "movement": "Camera movement following BLUE annotations",
+    "focal_length": "Lens choice (e.g., 24mm wide, 50mm normal, 85mm portrait)",
+    "depth_of_field": "Shallow/deep based on scene needs",
+    "stabilization": "Smooth/handheld/dynamic"
+  },
+  "subject_motion": {
+    "primary": "Main subject movement following RED annotations",
+    "path": "Specific path and timing from annotations",
+    "secondary_elements": "Other moving elements from GREEN annotations"
+  },
+  "visual_style": {
+    "treatment": "Cinematic/documentary/artistic based on mood",
+    "color_grading": "Color treatment matching scene mood",
+    "lighting": "Natural/dramatic/soft based on image"
+  },
+  "timing": {
+    "duration_seconds": 8,
+    "pacing": "Rhythm based on annotation timing",
+    "key_moments": "When important actions occur"
+  },
+  "technical_specs": {
+    "aspect_ratio": "16:9",
+    "resolution": "4K",
+    "frame_rate": "24fps cinematic",
+    "motion_blur": "Natural motion blur"
+  },
+  "audio_hints": {
+    "ambience": "Environmental sounds matching scene",
+    "music_style": "Mood-appropriate score",
+    "sound_effects": ["specific sounds for actions"]
+  },
+  "storyboard_integration": {
+    "follow_red_paths": "Primary motion as marked",
+    "follow_blue_camera": "Camera movement as indicated",
+    "highlight_green_elements": "Ensure focal points are featured",
+    "respect_orange_timing": "Match annotated duration and pacing"
+  },
+  "negative_prompt": "Avoid: shaky camera, abrupt cuts, unnatural motion",
+  "user_intent_integration": "<the user's video request> - incorporated throughout"
+}
+"""
+
+_VEO3_PROMPT = """
+Analyze this storyboard-annotated image and the user's video description to create a comprehensive Veo3 video generation specification.
+
+The image contains colored storyboard annotations:
+- RED markings: Primary subject movement paths
+- BLUE markings: Camera movement indicators  
+- GREEN markings: Secondary elements and focal points
+- ORANGE markings: Timing and scene information
 
-def image_to_base64(image: Image.Image) -> str:
+The user's video request follows the image.
+
+Generate a detailed JSON for Veo3 video generation that incorporates BOTH the storyboard annotations AND the user's vision:
+""" + _VEO3_JSON_SHAPE + """
+IMPORTANT: Read the actual annotations in the image and incorporate those specific movements, paths, and timings into your JSON response.
+"""
+
+# Extra user turn for the analysis model when the video is already described,
+# so one Gemini call also returns the Veo3 spec for the original image
+_VEO3_SPEC_REQUEST_TMPL = string.Template("""
+3. VEO3 SPECIFICATION - The user's video request: ${user_prompt}
+   Also include a top-level "veo3_spec" key in the same JSON object, shaped like this:
+""" + _VEO3_JSON_SHAPE)
+
+if GEMINI_API_KEY:
+    genai.configure(api_key=GEMINI_API_KEY)
+    # The fixed instructions are sent as system_instruction once per model
+    # handle instead of as a multi-KB user turn on every call
+    _ANALYZE_MODEL = genai.GenerativeModel(
+        'gemini-1.5-pro',
+        system_instruction=_ANALYZE_PROMPT,
+        generation_config={"response_mime_type": "application/json"}
+    )
+    _VEO3_MODEL = genai.GenerativeModel(
+        'gemini-1.5-pro',
+        system_instruction=_VEO3_PROMPT,
+        generation_config={"response_mime_type": "application/json"}
+    )
+else:
+    _ANALYZE_MODEL = None
+    _VEO3_MODEL = None
+
+# Fenced ```json block, or else the outermost {...} span
+_JSON_RE = re.compile(r"```json\s*(\{.*?\})\s*```|(\{.*\})", re.DOTALL)
+
+
+def _extract_json(text: str) -> str:
+    """Extract the JSON object from a Gemini response in a single scan"""
+    text = text.strip()
+    # JSON mode returns the bare object, so the regex is only a fallback
+    if text.startswith("{"):
+        return text
+    
+    match = _JSON_RE.search(text)
+    if match is None:
+        raise ValueError("No JSON object in model response")
+    return match.group(1) or match.group(2)
+
+
+
+def image_to_base64(image: Image.Image, format: str = 'JPEG') -> str:
     """Convert PIL image to base64"""
-    buffer = io.BytesIO()
-    image.save(buffer, format='PNG')
-    return base64.b64encode(buffer.getvalue()).decode()
+    if format == 'JPEG':
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        data = simplejpeg.encode_jpeg(np.asarray(image), quality=92, colorspace='RGB')
+    else:
+        with io.BytesIO() as buffer:
+            # Fast zlib level: the output is base64'd and uploaded once
+            image.save(buffer, format=format, optimize=False, compress_level=1)
+            data = buffer.getvalue()
+    return base64.b64encode(data).decode()
+
+
+def image_to_data_url(image: Image.Image) -> str:
+    """Convert PIL image to a data URL, JPEG unless alpha must be kept"""
+    if image.mode in ('RGBA', 'LA') or 'transparency' in image.info:
+        return f"data:image/png;base64,{image_to_base64(image, format='PNG')}"
+    return f"data:image/jpeg;base64,{image_to_base64(image)}"
 
 
-def generate_or_upload_image(image_upload, gen_prompt, state):
+def _generate_content(model, contents):
+    """Call Gemini, backing off exponentially when rate limited"""
+    for attempt in range(GEMINI_MAX_RETRIES):
+        try:
+            return model.generate_content(contents)
+        except ResourceExhausted:
+            if attempt == GEMINI_MAX_RETRIES - 1:
+                raise
+            time.sleep(2 ** attempt)
+
+
+def _image_key(image: Image.Image) -> bytes:
+    """Content hash of a PIL image for the caches"""
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(f"{image.mode}{image.size}".encode())
+    hasher.update(image.tobytes())
+    return hasher.digest()
+
+
+def _cache_get(cache: OrderedDict, key):
+    """Look up a cache entry, marking it most recently used"""
+    with _cache_lock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+    return None
+
+
+def _cache_put(cache: OrderedDict, key, value):
+    """Store a cache entry, evicting the least recently used past CACHE_SIZE"""
+    with _cache_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > CACHE_SIZE:
+            cache.popitem(last=False)
+
+
+async def _cancel_prediction(prediction):
+    """Best-effort cancel so an abandoned prediction stops running on Replicate"""
+    try:
+        await asyncio.to_thread(prediction.cancel)
+    except Exception:
+        pass
+
+
+async def _run_prediction(model: str, input: dict):
+    """Run a Replicate prediction, polling without blocking the event loop"""
+    prediction = await asyncio.to_thread(replicate.models.predictions.create, model=model, input=input)
+    
+    async def poll():
+        while prediction.status not in ("succeeded", "failed", "canceled"):
+            await asyncio.sleep(REPLICATE_POLL_INTERVAL)
+            await asyncio.to_thread(prediction.reload)
+    
+    # Stalled or abandoned predictions would otherwise hold a concurrency slot forever
+    try:
+        await asyncio.wait_for(poll(), timeout=REPLICATE_TIMEOUT)
+    except asyncio.TimeoutError:
+        await _cancel_prediction(prediction)
+        raise TimeoutError(f"Prediction did not finish within {REPLICATE_TIMEOUT}s") from None
+    except asyncio.CancelledError:
+        await _cancel_prediction(prediction)
+        raise
+    
+    if prediction.status != "succeeded":
+        raise RuntimeError(f"Prediction {prediction.status}: {prediction.error}")
+    return prediction.output
+
+
+def _output_url(output) -> str:
+    """URL of the first file in a Replicate output, iterating it at most once"""
+    url = getattr(output, "url", None)
+    if url is not None:
+        return url
+    if isinstance(output, str):
+        return output
+    first = next(iter(output), None) if hasattr(output, "__iter__") else output
+    if first is None:
+        raise ValueError("Replicate returned no output")
+    return getattr(first, "url", None) or str(first)
+
+
+def _preprocess_upload(path: str) -> Image.Image:
+    """Open an uploaded file as RGB at no more than MAX_UPLOAD_EDGE"""
+    image = Image.open(path)
+    if image.format == "JPEG":
+        # Let libjpeg decode at a reduced DCT scale instead of full resolution
+        image.draft("RGB", (MAX_UPLOAD_EDGE, MAX_UPLOAD_EDGE))
+    image.load()
+    # The raw file hasn't been through gr.Image, so apply its EXIF rotation here
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((MAX_UPLOAD_EDGE, MAX_UPLOAD_EDGE), Image.Resampling.LANCZOS)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return image
+
+
+def _response_text(response) -> str:
+    """Text of the first candidate, skipping response.text's merge and checks"""
+    # A blocked prompt comes back with no candidates, or a candidate with no parts
+    parts = response.candidates[0].content.parts if response.candidates else None
+    if not parts:
+        raise ValueError(f"Gemini returned no content (prompt feedback: {response.prompt_feedback})")
+    # JSON mode answers in a single part
+    return parts[0].text if len(parts) == 1 else "".join(part.text for part in parts)
+
+
+def _prepare_upload(image: Image.Image) -> Image.Image:
+    """Downscale an image to MAX_UPLOAD_EDGE before sending it to an API"""
+    if max(image.size) <= MAX_UPLOAD_EDGE:
+        return image
+    # Copy so the session's full-resolution image is left untouched
+    image = image.copy()
+    image.thumbnail((MAX_UPLOAD_EDGE, MAX_UPLOAD_EDGE), Image.Resampling.LANCZOS)
+    return image
+
+
+def _store_original(state, source) -> Image.Image:
+    """Decode an upload path or downloaded bytes into state.original_image"""
+    image = _preprocess_upload(source) if isinstance(source, str) else _open_image(source)
+    state.original_image = image
+    return image
+
+
+def _store_ai_annotated(state, data: bytes) -> Image.Image:
+    """Decode Flux output bytes into state.ai_annotated_image"""
+    image = _open_image(data)
+    state.ai_annotated_image = image
+    return image
+
+
+async def generate_or_upload_image(image_upload, gen_prompt, state):
     """Handle both image upload and generation"""
+    # Decoding and re-encoding for the state are CPU-bound, so they run in a
+    # worker thread rather than on the event loop every session shares
     if image_upload is not None:
-        state.original_image = image_upload
-        return image_upload, "✅ Image uploaded", state
+        # gr.File only filters by extension in the browser, so the file may
+        # still not be a readable image
+        try:
+            image = await asyncio.to_thread(_store_original, state, image_upload)
+            return image, "✅ Image uploaded", state
+        except Exception as e:
+            return None, f"❌ Upload error: {str(e)}", state
     
     if gen_prompt and gen_prompt.strip():
         if not REPLICATE_API_TOKEN:
-            return None, "❌ Replicate API not configured"
+            return None, "❌ Replicate API not configured", state
         
         try:
-            output = replicate.run(
+            output = await _run_prediction(
                 "black-forest-labs/flux-schnell",
                 input={
                     "prompt": gen_prompt,
@@ -70,11 +519,10 @@ def generate_or_upload_image(image_upload, gen_prompt, state):
                 }
             )
             
-            if output and len(output) > 0:
-                import requests
-                response = requests.get(output[0])
-                image = Image.open(io.BytesIO(response.content))
-                state.original_image = image
+            if output:
+                response = await asyncio.to_thread(_SESSION.get, _output_url(output), timeout=30)
+                response.raise_for_status()
+                image = await asyncio.to_thread(_store_original, state, response.content)
                 return image, "✅ Image generated", state
                 
         except Exception as e:
@@ -83,88 +531,50 @@ def generate_or_upload_image(image_upload, gen_prompt, state):
     return None, "❌ Please upload an image or enter a generation prompt", state
 
 
-def analyze_for_annotations(image, state):
+def analyze_for_annotations(image, state, user_prompt=""):
     """Analyze image and generate annotation instructions"""
     if image is None:
         return "", "", "❌ No image provided", state
     
-    if not vision_model:
+    # Drop results for the previous image so a failed analysis can't leave
+    # them paired with this one
+    state.annotation_instructions = None
+    state.overview_data = None
+    state.veo3_spec = None
+    
+    if not _ANALYZE_MODEL:
         return "", "", "❌ Gemini Vision API not configured", state
     
     try:
-        prompt = """
-        Analyze this image for video storyboarding. Provide a detailed analysis with TWO outputs:
-
-        1. SCENE OVERVIEW - Analyze the image and identify:
-           - Main subjects and their potential motion paths
-           - Camera movement opportunities (pan, zoom, track, arc)
-           - Key focal points and composition elements
-           - Lighting and mood
-           - Foreground, midground, background elements
-
-        2. STORYBOARD ANNOTATION INSTRUCTIONS - Create specific markup instructions:
-           - Identify 3-5 elements that should move or animate
-           - For each element, specify:
-             * What it is and where it's located
-             * How it should move (direction, speed, path)
-             * What color annotation to use (RED for hero elements, BLUE for camera, GREEN for secondary, ORANGE for timing)
-             * Specific arrow types and labels
-
-        Return a JSON response like this:
-        {
-          "scene_overview": {
-            "description": "Detailed 2-3 sentence scene description",
-            "main_subject": "Primary focus and its location",
-            "secondary_elements": ["element1", "element2"],
-            "mood": "Emotional tone",
-            "lighting": "Quality and direction",
-            "camera_opportunities": "Possible camera movements",
-            "motion_potential": "What could move and how"
-          },
-          "annotation_instructions": {
-            "hero_element": {
-              "what": "The main subject (e.g., boat, person, car)",
-              "location": "Where in frame (e.g., center-left)",
-              "motion": "How it moves (e.g., drifts right slowly)",
-              "annotation": "RED CIRCLE around [element]",
-              "arrow": "Curved RED ARROW showing path to the right",
-              "label": "HERO MOVES → 3 SEC"
-            },
-            "camera_motion": {
-              "type": "Camera movement type (e.g., arc, dolly, pan)",
-              "path": "Movement description",
-              "annotation": "BLUE DOTTED LINE showing path",
-              "arrows": "BLUE ARROWS at key points",
-              "label": "CAMERA ARCS 90°"
-            },
-            "secondary_elements": [
-              {
-                "what": "Secondary element",
-                "motion": "Its movement",
-                "annotation": "GREEN BOX or CIRCLE",
-                "label": "ELEMENT ACTION"
-              }
-            ],
-            "timing": {
-              "duration": "8 seconds",
-              "annotation": "ORANGE TEXT top-right",
-              "label": "SCENE 1 - 8 SEC"
-            }
-          }
-        }
-        """
-        
-        response = vision_model.generate_content([image, prompt])
-        json_text = response.text
+        user_prompt = (user_prompt or "").strip()
+        image_key = _image_key(image)
+        spec_key = (image_key, user_prompt)
+        veo3_spec = _cache_get(_VEO3_SPEC_CACHE, spec_key) if user_prompt else None
         
-        if "```json" in json_text:
-            json_text = json_text.split("```json")[1].split("```")[0]
-        elif "{" in json_text:
-            json_text = json_text[json_text.find("{"):json_text.rfind("}")+1]
+        # The analysis depends only on the image, so editing the video prompt
+        # reuses it; the spec is then generated on demand by the Veo3 step
+        cached = _cache_get(_ANALYSIS_CACHE, image_key)
+        if cached is None:
+            contents = [image]
+            if user_prompt and veo3_spec is None:
+                contents.append(_VEO3_SPEC_REQUEST_TMPL.substitute(user_prompt=user_prompt))
+            response = _generate_content(_ANALYZE_MODEL, contents)
+            json_text = _extract_json(_response_text(response))
+            data = orjson.loads(json_text)
+            
+            # Split the Veo3 spec off so the instructions display stays as before
+            spec = data.pop("veo3_spec", None)
+            if spec is not None:
+                json_text = orjson.dumps(data, option=orjson.OPT_INDENT_2).decode()
+                veo3_spec = (user_prompt, orjson.dumps(spec, option=orjson.OPT_INDENT_2).decode())
+                _cache_put(_VEO3_SPEC_CACHE, spec_key, veo3_spec)
+            _cache_put(_ANALYSIS_CACHE, image_key, (json_text, data))
+        else:
+            json_text, data = cached
         
-        # Parse and store
-        data = json.loads(json_text)
-        state.annotation_instructions = json_text
+        # Store the parsed dict so annotation doesn't have to re-parse it
+        state.annotation_instructions = data
+        state.veo3_spec = veo3_spec
         state.overview_data = data.get("scene_overview", {})
         
         # Format overview for display
@@ -181,19 +591,32 @@ def analyze_for_annotations(image, state):
         return "", "", f"❌ Analysis error: {str(e)}", state
 
 
-def create_ai_annotations(image, instructions, state):
+async def create_ai_annotations(image, instructions, state):
     """Create AI-generated annotations using Flux"""
     if image is None:
         return None, "❌ No image provided", state
     
-    if not instructions or instructions.strip() == "":
+    if not instructions or (isinstance(instructions, str) and instructions.strip() == ""):
         return None, "❌ No annotation instructions", state
     
     if not REPLICATE_API_TOKEN:
         return None, "❌ Replicate API not configured", state
     
     try:
-        instructions_dict = json.loads(instructions)
+        if isinstance(instructions, dict):
+            instructions_dict = instructions
+        else:
+            instructions_dict = orjson.loads(instructions)
+        
+        # Reuse the Flux output for an image/instructions pair seen before
+        instructions_key = hashlib.blake2b(
+            orjson.dumps(instructions_dict, option=orjson.OPT_SORT_KEYS), digest_size=16
+        ).digest()
+        cache_key = (await asyncio.to_thread(_image_key, image), instructions_key)
+        cached_png = _cache_get(_ANNOTATION_CACHE, cache_key)
+        if cached_png is not None:
+            annotated_image = await asyncio.to_thread(_store_ai_annotated, state, cached_png)
+            return annotated_image, "✅ AI annotations created (cached)", state
         
         # Build natural language prompt for Flux Kontext
         ann_inst = instructions_dict.get("annotation_instructions", {})
@@ -238,9 +661,9 @@ def create_ai_annotations(image, instructions, state):
         
         annotation_prompt = "\n".join(prompt_parts)
         
-        img_data_url = f"data:image/png;base64,{image_to_base64(image)}"
+        img_data_url = await asyncio.to_thread(lambda: image_to_data_url(_prepare_upload(image)))
         
-        output = replicate.run(
+        output = await _run_prediction(
             "black-forest-labs/flux-kontext-max",
             input={
                 "prompt": annotation_prompt,
@@ -251,22 +674,11 @@ def create_ai_annotations(image, instructions, state):
         )
         
         if output:
-            import requests
-            if hasattr(output, 'url'):
-                image_url = output.url
-            elif hasattr(output, '__iter__') and len(list(output)) > 0:
-                first_item = list(output)[0]
-                image_url = first_item.url if hasattr(first_item, 'url') else str(first_item)
-            else:
-                image_url = str(output)
-            
-            response = requests.get(image_url)
-            if response.status_code == 200:
-                annotated_image = Image.open(io.BytesIO(response.content))
-                state.ai_annotated_image = annotated_image
-                return annotated_image, "✅ AI annotations created", state
-            else:
-                return None, f"❌ Failed to download annotated image: {response.status_code}", state
+            response = await asyncio.to_thread(_SESSION.get, _output_url(output), timeout=30)
+            response.raise_for_status()
+            _cache_put(_ANNOTATION_CACHE, cache_key, response.content)
+            annotated_image = await asyncio.to_thread(_store_ai_annotated, state, response.content)
+            return annotated_image, "✅ AI annotations created", state
             
     except Exception as e:
         return None, f"❌ Annotation error: {str(e)}", state
@@ -276,20 +688,28 @@ def create_ai_annotations(image, instructions, state):
 
 def save_manual_annotations(editor_data, state):
     """Save manual annotations from the editor"""
-    if editor_data and "composite" in editor_data:
-        state.manual_annotated_image = editor_data["composite"]
-        return state.manual_annotated_image, "✅ Manual annotations saved", state
-    return None, "❌ No manual annotations to save", state
+    if not editor_data or "composite" not in editor_data:
+        return None, "❌ No manual annotations to save", state
+    
+    # A composite with no visible strokes is just the background again
+    layers = editor_data.get("layers") or []
+    if not any(np.asarray(layer.convert("RGBA"))[..., 3].any() for layer in layers):
+        return state.get_current_image(), "ℹ️ No strokes detected — keeping current image", state
+    
+    state.manual_annotated_image = editor_data["composite"]
+    return editor_data["composite"], "✅ Manual annotations saved", state
 
 
 def get_selected_image(choice, state):
     """Get image based on user choice"""
-    if choice == "AI Annotated" and state.ai_annotated_image:
-        return state.ai_annotated_image
-    elif choice == "Manual Annotated" and state.manual_annotated_image:
-        return state.manual_annotated_image
+    # Each property access decodes the stored image, so read it once
+    if choice == "AI Annotated":
+        image = state.ai_annotated_image
+    elif choice == "Manual Annotated":
+        image = state.manual_annotated_image
     else:
-        return state.original_image
+        image = None
+    return image or state.original_image
 
 def generate_veo3_json(user_prompt, image_choice, state):
     """Generate final Veo3 JSON"""
@@ -301,81 +721,23 @@ def generate_veo3_json(user_prompt, image_choice, state):
     if not user_prompt or user_prompt.strip() == "":
         return "", "❌ Please describe your video"
     
-    if not vision_model:
+    if not _VEO3_MODEL:
         return "", "❌ Vision API not configured"
     
+    # The analysis call already produced a spec for the original image and
+    # this prompt, so only annotated images need another Gemini call
+    if image_choice == "Original" and state.veo3_spec and state.veo3_spec[0] == user_prompt.strip():
+        return state.veo3_spec[1], "✅ Veo3 JSON generated"
+    
     try:
-        analysis_prompt = f"""
-        Analyze this storyboard-annotated image and the user's video description to create a comprehensive Veo3 video generation specification.
-
-        The image contains colored storyboard annotations:
-        - RED markings: Primary subject movement paths
-        - BLUE markings: Camera movement indicators  
-        - GREEN markings: Secondary elements and focal points
-        - ORANGE markings: Timing and scene information
-
-        User's video request: {user_prompt}
-
-        Generate a detailed JSON for Veo3 video generation that incorporates BOTH the storyboard annotations AND the user's vision:
-
-        {{
-          "prompt": "Main video generation prompt combining scene + user request",
-          "scene_description": "Detailed 2-3 sentence description incorporating annotated elements",
-          "camera": {{
-            "initial_position": "Starting camera position",
-            "movement": "Camera movement following BLUE annotations",
-            "focal_length": "Lens choice (e.g., 24mm wide, 50mm normal, 85mm portrait)",
-            "depth_of_field": "Shallow/deep based on scene needs",
-            "stabilization": "Smooth/handheld/dynamic"
-          }},
-          "subject_motion": {{
-            "primary": "Main subject movement following RED annotations",
-            "path": "Specific path and timing from annotations",
-            "secondary_elements": "Other moving elements from GREEN annotations"
-          }},
-          "visual_style": {{
-            "treatment": "Cinematic/documentary/artistic based on mood",
-            "color_grading": "Color treatment matching scene mood",
-            "lighting": "Natural/dramatic/soft based on image"
-          }},
-          "timing": {{
-            "duration_seconds": 8,
-            "pacing": "Rhythm based on annotation timing",
-            "key_moments": "When important actions occur"
-          }},
-          "technical_specs": {{
-            "aspect_ratio": "16:9",
-            "resolution": "4K",
-            "frame_rate": "24fps cinematic",
-            "motion_blur": "Natural motion blur"
-          }},
-          "audio_hints": {{
-            "ambience": "Environmental sounds matching scene",
-            "music_style": "Mood-appropriate score",
-            "sound_effects": ["specific sounds for actions"]
-          }},
-          "storyboard_integration": {{
-            "follow_red_paths": "Primary motion as marked",
-            "follow_blue_camera": "Camera movement as indicated",
-            "highlight_green_elements": "Ensure focal points are featured",
-            "respect_orange_timing": "Match annotated duration and pacing"
-          }},
-          "negative_prompt": "Avoid: shaky camera, abrupt cuts, unnatural motion",
-          "user_intent_integration": "{user_prompt} - incorporated throughout"
-        }}
-
-        IMPORTANT: Read the actual annotations in the image and incorporate those specific movements, paths, and timings into your JSON response.
-        """
-        
-        response = vision_model.generate_content([image, analysis_prompt])
-        json_text = response.text
-        
-        if "```json" in json_text:
-            json_text = json_text.split("```json")[1].split("```")[0]
-        elif "{" in json_text:
-            json_text = json_text[json_text.find("{"):json_text.rfind("}")+1]
+        response = _generate_content(
+            _VEO3_MODEL, [_prepare_upload(image), f"User's video request: {user_prompt}"]
+        )
+        json_text = _extract_json(_response_text(response))
         
-        json.loads(json_text)  # Validate JSON
+        # JSON mode already guarantees valid JSON; only check it is an object
+        if not (json_text.startswith("{") and json_text.rstrip().endswith("}")):
+            raise ValueError("Model response is not a JSON object")
         
         return json_text, "✅ Veo3 JSON generated"
         
@@ -385,8 +747,8 @@ def generate_veo3_json(user_prompt, image_choice, state):
 
 # Build the interface
 with gr.Blocks(title="Veo3 Complete", theme=gr.themes.Soft()) as app:
-    # Create state object for this session
-    app_state = gr.State(Veo3State())
+    # Gradio calls the factory per session, so each gets its own fresh object
+    app_state = gr.State(Veo3State)
     
     gr.Markdown("# 🎬 Veo3 Prompt Generator - Complete Workflow")
     
@@ -397,7 +759,9 @@ with gr.Blocks(title="Veo3 Complete", theme=gr.themes.Soft()) as app:
             gr.Markdown("### 1️⃣ Start with an Image")
             with gr.Tabs():
                 with gr.TabItem("Upload"):
-                    image_upload = gr.Image(type="pil", label="Upload Image")
+                    # gr.File hands over the file as uploaded; gr.Image would
+                    # decode and re-encode it at full size before we see it
+                    image_upload = gr.File(file_types=["image"], type="filepath", label="Upload Image")
                 with gr.TabItem("Generate"):
                     gen_prompt = gr.Textbox(
                         label="Generate Image",
@@ -476,32 +840,39 @@ with gr.Blocks(title="Veo3 Complete", theme=gr.themes.Soft()) as app:
             )
     
     # Wire up the interface
-    def process_and_analyze(image_upload, gen_prompt, state):
+    async def process_and_analyze(image_upload, gen_prompt, video_prompt, state):
         # Get image
-        image, status_msg, state = generate_or_upload_image(image_upload, gen_prompt, state)
+        image, status_msg, state = await generate_or_upload_image(image_upload, gen_prompt, state)
         if image is None:
             return None, status_msg, "", "", [], state
         
-        # Analyze
-        overview, instructions, analyze_status, state = analyze_for_annotations(image, state)
+        # Analyze, drafting the Veo3 spec too if the video is already described
+        overview, instructions, analyze_status, state = await asyncio.to_thread(
+            analyze_for_annotations, image, state, video_prompt
+        )
         
         # Update gallery
-        gallery_images = update_gallery(state)
+        gallery_images = await asyncio.to_thread(update_gallery, state)
         
         # Update editor with current image
         return image, f"{status_msg} → {analyze_status}", overview, instructions, gallery_images, state
     
-    def create_annotations(state):
-        if state.original_image is None:
-            return None, "❌ No image loaded", state.original_image, [], state
+    async def create_annotations(state):
+        # Property access decodes the stored JPEG
+        original = await asyncio.to_thread(lambda: state.original_image)
+        if original is None:
+            return None, "❌ No image loaded", None, [], state
         
-        annotated, status_msg, state = create_ai_annotations(state.original_image, state.annotation_instructions, state)
-        gallery_images = update_gallery(state)
+        annotated, status_msg, state = await create_ai_annotations(original, state.annotation_instructions, state)
+        gallery_images = await asyncio.to_thread(update_gallery, state)
         if annotated:
             # Update editor with original image for manual annotations
-            return annotated, status_msg, state.original_image, gallery_images, state
+            return annotated, status_msg, original, gallery_images, state
         else:
-            return state.original_image, status_msg, state.original_image, gallery_images, state
+            return original, status_msg, original, gallery_images, state
+    
+    async def generate_veo3(user_prompt, image_choice, state):
+        return await asyncio.to_thread(generate_veo3_json, user_prompt, image_choice, state)
     
     def update_editor_on_manual_save(editor_data, state):
         img, status_msg, state = save_manual_annotations(editor_data, state)
@@ -517,20 +888,15 @@ with gr.Blocks(title="Veo3 Complete", theme=gr.themes.Soft()) as app:
     
     def update_gallery(state):
         """Update gallery with all available images"""
-        images = []
-        if state.original_image:
-            images.append((state.original_image, "Original"))
-        if state.ai_annotated_image:
-            images.append((state.ai_annotated_image, "AI Annotated"))
-        if state.manual_annotated_image:
-            images.append((state.manual_annotated_image, "Manual Annotated"))
-        return images
+        return state.gallery_items()
     
     # Connect buttons
     process_btn.click(
         process_and_analyze,
-        inputs=[image_upload, gen_prompt, app_state],
-        outputs=[current_image, status, overview_display, instructions_display, image_gallery, app_state]
+        inputs=[image_upload, gen_prompt, user_prompt, app_state],
+        outputs=[current_image, status, overview_display, instructions_display, image_gallery, app_state],
+        concurrency_limit=GEMINI_CONCURRENCY_LIMIT,
+        concurrency_id="gemini"
     ).then(
         lambda img: img,
         inputs=[current_image],
@@ -556,10 +922,14 @@ with gr.Blocks(title="Veo3 Complete", theme=gr.themes.Soft()) as app:
     )
     
     generate_veo3_btn.click(
-        generate_veo3_json,
+        generate_veo3,
         inputs=[user_prompt, image_choice, app_state],
-        outputs=[veo3_output, status]
+        outputs=[veo3_output, status],
+        concurrency_limit=GEMINI_CONCURRENCY_LIMIT,
+        concurrency_id="gemini"
     )
 
 if __name__ == "__main__":
-    app.launch(share=True)
\ No newline at end of file
+    # Handlers spend their time waiting on Gemini/Replicate, so let several
+    # sessions run at once instead of Gradio's default of one per event
+    app.queue(default_concurrency_limit=10).launch(share=True)
\ No newline at end of file